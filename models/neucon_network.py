@@ -1,4 +1,3 @@
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -6,7 +5,7 @@ from torchsparse.tensor import PointTensor
 from loguru import logger
 
 from models.modules import SPVCNN
-from utils import apply_log_transform
+from utils import tsdf_log_l1
 from .gru_fusion import GRUFusion
 from ops.back_project import back_project
 from ops.generate_grids import generate_grid
@@ -42,9 +41,8 @@ class NeuConNet(nn.Module):
             self.gru_fusion = GRUFusion(cfg, channels)
         # sparse conv
         self.sp_convs = nn.ModuleList()
-        # MLPs that predict tsdf and occupancy.
-        self.tsdf_preds = nn.ModuleList()
-        self.occ_preds = nn.ModuleList()
+        # MLPs that predict tsdf and occupancy, fused into one linear layer: (tsdf, occ)
+        self.tsdf_occ_preds = nn.ModuleList()
         for i in range(len(cfg.THRESHOLDS)):
             self.sp_convs.append(
                 SPVCNN(num_classes=1, in_channels=ch_in[i],
@@ -53,8 +51,30 @@ class NeuConNet(nn.Module):
                        vres=self.cfg.VOXEL_SIZE * 2 ** (self.n_scales - i),
                        dropout=self.cfg.SPARSEREG.DROPOUT)
             )
-            self.tsdf_preds.append(nn.Linear(channels[i], 1))
-            self.occ_preds.append(nn.Linear(channels[i], 1))
+            self.tsdf_occ_preds.append(nn.Linear(channels[i], 2))
+
+        # offsets (x, y, z) of the 8 children of a voxel, the first one is the voxel itself
+        self.register_buffer('up_offsets', torch.tensor([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1],
+                                                         [1, 1, 0], [1, 0, 1], [0, 1, 1], [1, 1, 1]],
+                                                        dtype=torch.int32), persistent=False)
+        # coarsest voxel grid, (number of voxels, 3), identical for every forward pass
+        self.register_buffer('base_grid', generate_grid(cfg.N_VOX, 2 ** self.n_scales, device='cpu')[0]
+                             .permute(1, 0).contiguous(), persistent=False)
+        # placeholder loss when no ground truth is available
+        self.register_buffer('zero_loss', torch.zeros(()), persistent=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        # checkpoints saved before the heads were fused keep separate tsdf_preds / occ_preds layers
+        for i in range(len(self.tsdf_occ_preds)):
+            for name in ['weight', 'bias']:
+                tsdf_key = '{}tsdf_preds.{}.{}'.format(prefix, i, name)
+                occ_key = '{}occ_preds.{}.{}'.format(prefix, i, name)
+                if tsdf_key in state_dict and occ_key in state_dict:
+                    state_dict['{}tsdf_occ_preds.{}.{}'.format(prefix, i, name)] = torch.cat(
+                        [state_dict.pop(tsdf_key), state_dict.pop(occ_key)], dim=0)
+        super(NeuConNet, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys,
+                                                     unexpected_keys, error_msgs)
 
     def get_target(self, coords, inputs, scale):
         '''
@@ -68,11 +88,13 @@ class NeuConNet(nn.Module):
         with torch.no_grad():
             tsdf_target = inputs['tsdf_list'][scale]
             occ_target = inputs['occ_list'][scale]
-            coords_down = coords.detach().clone().long()
-            # 2 ** scale == interval
-            coords_down[:, 1:] = (coords[:, 1:] // 2 ** scale)
-            tsdf_target = tsdf_target[coords_down[:, 0], coords_down[:, 1], coords_down[:, 2], coords_down[:, 3]]
-            occ_target = occ_target[coords_down[:, 0], coords_down[:, 1], coords_down[:, 2], coords_down[:, 3]]
+            coords = coords.long()
+            _, dim_x, dim_y, dim_z = tsdf_target.shape
+            # 2 ** scale == interval, coords are non-negative so a shift equals the floor division
+            lin_ind = ((coords[:, 0] * dim_x + (coords[:, 1] >> scale)) * dim_y
+                       + (coords[:, 2] >> scale)) * dim_z + (coords[:, 3] >> scale)
+            tsdf_target = torch.take(tsdf_target, lin_ind)
+            occ_target = torch.take(occ_target, lin_ind)
             return tsdf_target, occ_target
 
     def upsample(self, pre_feat, pre_coords, interval, num=8):
@@ -86,14 +108,11 @@ class NeuConNet(nn.Module):
         :return: up_coords: (N*8, 4), upsampled coordinates, (4 : Batch ind, x, y, z)
         '''
         with torch.no_grad():
-            pos_list = [1, 2, 3, [1, 2], [1, 3], [2, 3], [1, 2, 3]]
             n, c = pre_feat.shape
-            up_feat = pre_feat.unsqueeze(1).expand(-1, num, -1).contiguous()
-            up_coords = pre_coords.unsqueeze(1).repeat(1, num, 1).contiguous()
-            for i in range(num - 1):
-                up_coords[:, i + 1, pos_list[i]] += interval
+            up_feat = pre_feat.unsqueeze(1).expand(-1, num, -1).reshape(-1, c)
+            up_coords = pre_coords.unsqueeze(1).expand(-1, num, -1).clone()
+            up_coords[:, :, 1:] += self.up_offsets[:num] * interval
 
-            up_feat = up_feat.view(-1, c)
             up_coords = up_coords.view(-1, 4)
 
         return up_feat, up_coords
@@ -101,7 +120,7 @@ class NeuConNet(nn.Module):
     def forward(self, features, inputs, outputs):
         '''
 
-        :param features: list: features for each image: eg. list[0] : pyramid features for image0 : [(B, C0, H, W), (B, C1, H/2, W/2), (B, C2, H/2, W/2)]
+        :param features: list: multi-view features for each scale: eg. list[0] : features of scale 0 for all images : (N_views, B, C0, H, W)
         :param inputs: meta data from dataloader
         :param outputs: {}
         :return: outputs: dict: {
@@ -114,10 +133,12 @@ class NeuConNet(nn.Module):
             'tsdf_occ_loss_X':         (Tensor), multi level loss
         }
         '''
-        bs = features[0][0].shape[0]
+        bs = features[0].shape[1]
         pre_feat = None
         pre_coords = None
         loss_dict = {}
+        # (number of scales, number of views, batch size, 4, 4), packed once for all scales
+        proj_matrices = inputs['proj_matrices'].permute(2, 1, 0, 3, 4).contiguous()
         # ----coarse to fine----
         for i in range(self.cfg.N_LAYER):
             interval = 2 ** (self.n_scales - i)
@@ -125,18 +146,18 @@ class NeuConNet(nn.Module):
 
             if i == 0:
                 # ----generate new coords----
-                coords = generate_grid(self.cfg.N_VOX, interval)[0]
-                up_coords = []
-                for b in range(bs):
-                    up_coords.append(torch.cat([torch.ones(1, coords.shape[-1]).to(coords.device) * b, coords]))
-                up_coords = torch.cat(up_coords, dim=1).permute(1, 0).contiguous()
+                coords = self.base_grid
+                n_vox = coords.shape[0]
+                batch_col = torch.arange(bs, device=coords.device, dtype=coords.dtype).view(bs, 1, 1)
+                up_coords = torch.cat([batch_col.expand(-1, n_vox, -1), coords.unsqueeze(0).expand(bs, -1, -1)],
+                                      dim=-1).view(-1, 4)
             else:
                 # ----upsample coords----
                 up_feat, up_coords = self.upsample(pre_feat, pre_coords, interval)
 
             # ----back project----
-            feats = torch.stack([feat[scale] for feat in features])
-            KRcam = inputs['proj_matrices'][:, :, scale].permute(1, 0, 2, 3).contiguous()
+            feats = features[scale]
+            KRcam = proj_matrices[scale]
             volume, count = back_project(up_coords, inputs['vol_origin_partial'], self.cfg.VOXEL_SIZE, feats,
                                          KRcam)
             grid_mask = count > 1
@@ -151,17 +172,16 @@ class NeuConNet(nn.Module):
                 tsdf_target, occ_target = self.get_target(up_coords, inputs, scale)
 
             # ----convert to aligned camera coordinate----
-            r_coords = up_coords.detach().clone().float()
-            for b in range(bs):
-                batch_ind = torch.nonzero(up_coords[:, 0] == b).squeeze(1)
-                coords_batch = up_coords[batch_ind][:, 1:].float()
-                coords_batch = coords_batch * self.cfg.VOXEL_SIZE + inputs['vol_origin_partial'][b].float()
-                coords_batch = torch.cat((coords_batch, torch.ones_like(coords_batch[:, :1])), dim=1)
-                coords_batch = coords_batch @ inputs['world_to_aligned_camera'][b, :3, :].permute(1, 0).contiguous()
-                r_coords[batch_ind, 1:] = coords_batch
-
+            batch_ids = up_coords[:, 0].long()
+            coords_world = up_coords[:, 1:].float() * self.cfg.VOXEL_SIZE + \
+                inputs['vol_origin_partial'][batch_ids].float()
+            coords_world = torch.cat((coords_world, torch.ones_like(coords_world[:, :1])), dim=1)
+            # per voxel 3x4 transform gathered by batch index, (N, 3, 4)
+            w2a = inputs['world_to_aligned_camera'][batch_ids, :3, :]
+            r_coords = torch.empty(up_coords.shape[0], 4, device=up_coords.device)
+            r_coords[:, :3] = (w2a @ coords_world.unsqueeze(-1)).squeeze(-1)
             # batch index is in the last position
-            r_coords = r_coords[:, [1, 2, 3, 0]]
+            r_coords[:, 3] = up_coords[:, 0]
 
             # ----sparse conv 3d backbone----
             point_feat = PointTensor(feat, r_coords)
@@ -173,8 +193,7 @@ class NeuConNet(nn.Module):
                 if self.cfg.FUSION.FULL:
                     grid_mask = torch.ones_like(feat[:, 0]).bool()
 
-            tsdf = self.tsdf_preds[i](feat)
-            occ = self.occ_preds[i](feat)
+            tsdf, occ = self.tsdf_occ_preds[i](feat).split(1, dim=1)
 
             # -------compute loss-------
             if tsdf_target is not None:
@@ -182,14 +201,16 @@ class NeuConNet(nn.Module):
                                          mask=grid_mask,
                                          pos_weight=self.cfg.POS_WEIGHT)
             else:
-                loss = torch.Tensor(np.array([0]))[0]
+                loss = self.zero_loss
             loss_dict.update({f'tsdf_occ_loss_{i}': loss})
 
             # ------define the sparsity for the next stage-----
             occupancy = occ.squeeze(1) > self.cfg.THRESHOLDS[i]
             occupancy[grid_mask == False] = False
 
-            num = int(occupancy.sum().data.cpu())
+            # the size of the index is known on the host once nonzero returns, no extra sync for the count
+            ind = occupancy.nonzero(as_tuple=True)[0]
+            num = ind.numel()
 
             if num == 0:
                 logger.warning('no valid points: scale {}'.format(i))
@@ -197,21 +218,21 @@ class NeuConNet(nn.Module):
 
             # ------avoid out of memory: sample points if num of points is too large-----
             if self.training and num > self.cfg.TRAIN_NUM_SAMPLE[i] * bs:
-                choice = np.random.choice(num, num - self.cfg.TRAIN_NUM_SAMPLE[i] * bs,
-                                          replace=False)
-                ind = torch.nonzero(occupancy)
-                occupancy[ind[choice]] = False
-
-            pre_coords = up_coords[occupancy]
-            for b in range(bs):
-                batch_ind = torch.nonzero(pre_coords[:, 0] == b).squeeze(1)
-                if len(batch_ind) == 0:
-                    logger.warning('no valid points: scale {}, batch {}'.format(i, b))
-                    return outputs, loss_dict
-
-            pre_feat = feat[occupancy]
-            pre_tsdf = tsdf[occupancy]
-            pre_occ = occ[occupancy]
+                choice = torch.randperm(num, device=ind.device)[:num - self.cfg.TRAIN_NUM_SAMPLE[i] * bs]
+                keep = torch.ones_like(ind, dtype=torch.bool)
+                keep[choice] = False
+                ind = ind[keep]
+
+            pre_coords = up_coords.index_select(0, ind)
+            n_per_batch = torch.bincount(pre_coords[:, 0].long(), minlength=bs)
+            if n_per_batch.min() == 0:
+                b = int(torch.argmin(n_per_batch))
+                logger.warning('no valid points: scale {}, batch {}'.format(i, b))
+                return outputs, loss_dict
+
+            pre_feat = feat.index_select(0, ind)
+            pre_tsdf = tsdf.index_select(0, ind)
+            pre_occ = occ.index_select(0, ind)
 
             pre_feat = torch.cat([pre_feat, pre_tsdf, pre_occ], dim=1)
 
@@ -241,17 +262,18 @@ class NeuConNet(nn.Module):
         tsdf_target = tsdf_target.view(-1)
         occ_target = occ_target.view(-1)
         if mask is not None:
-            mask = mask.view(-1)
-            tsdf = tsdf[mask]
-            occ = occ[mask]
-            tsdf_target = tsdf_target[mask]
-            occ_target = occ_target[mask]
+            # index once and share it across all tensors
+            ind = mask.view(-1).nonzero(as_tuple=True)[0]
+            tsdf = tsdf.index_select(0, ind)
+            occ = occ.index_select(0, ind)
+            tsdf_target = tsdf_target.index_select(0, ind)
+            occ_target = occ_target.index_select(0, ind)
 
         n_all = occ_target.shape[0]
         n_p = occ_target.sum()
         if n_p == 0:
             logger.warning('target: no valid voxel when computing loss')
-            return torch.Tensor([0.0]).cuda()[0] * tsdf.sum()
+            return tsdf.sum() * 0
         w_for_1 = (n_all - n_p).float() / n_p
         w_for_1 *= pos_weight
 
@@ -259,9 +281,7 @@ class NeuConNet(nn.Module):
         occ_loss = F.binary_cross_entropy_with_logits(occ, occ_target.float(), pos_weight=w_for_1)
 
         # compute tsdf l1 loss
-        tsdf = apply_log_transform(tsdf[occ_target])
-        tsdf_target = apply_log_transform(tsdf_target[occ_target])
-        tsdf_loss = torch.mean(torch.abs(tsdf - tsdf_target))
+        tsdf_loss = tsdf_log_l1(tsdf[occ_target], tsdf_target[occ_target])
 
         # compute final loss
         loss = loss_weight[0] * occ_loss + loss_weight[1] * tsdf_loss
@@ -35,7 +35,8 @@ class NeuralRecon(nn.Module):
         if self.nnet_args:
             self.nnet = NNET(nnet_args)
             loadckpt = os.path.join(cfg.TRAIN.PATH, 'scannet.pt')
-            state_dict = torch.load(loadckpt)
+            # weights are copied into the (cpu) parameters, avoid staging them on the gpu
+            state_dict = torch.load(loadckpt, map_location='cpu')
             self.nnet.load_state_dict(state_dict['model'])
             del state_dict
             # self.nnet.cuda()
@@ -150,6 +151,9 @@ class NeuralRecon(nn.Module):
             # in: normalized images; out: feature maps
             features = [self.backbone2d(img) for img in imgs]
 
+        # regroup per scale: [(number of views, B, C, H, W)]
+        features = [torch.stack(feats) for feats in zip(*features)]
+
         # coarse-to-fine decoder: SparseConv and GRU Fusion.
         # in: image features; out: sparse coords and tsdf
         outputs, loss_dict = self.neucon_net(features, inputs, outputs)
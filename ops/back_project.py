@@ -21,64 +21,63 @@ def back_project(coords, origin, voxel_size, feats, KRcam):
     dim: (num of voxels,)
     '''
     n_views, bs, c, h, w = feats.shape
+    n_vox = coords.shape[0]
+    device = coords.device
 
-    feature_volume_all = torch.zeros(coords.shape[0], c + 1).cuda()
-    count = torch.zeros(coords.shape[0]).cuda()
+    # scatter the voxels into a (batch size, max num of voxels per batch) layout
+    batch_ind = coords[:, 0].long()
+    n_per_batch = torch.bincount(batch_ind, minlength=bs)
+    n_max = int(n_per_batch.max())
+    # stable sort by batch index, gives the position of each voxel inside its batch
+    order = torch.argsort(batch_ind * n_vox + torch.arange(n_vox, device=device))
+    offsets = torch.cumsum(n_per_batch, dim=0) - n_per_batch
+    pos = torch.empty_like(batch_ind)
+    pos[order] = torch.arange(n_vox, device=device) - offsets[batch_ind[order]]
 
-    for batch in range(bs):
-        batch_ind = torch.nonzero(coords[:, 0] == batch).squeeze(1)
-        coords_batch = coords[batch_ind][:, 1:]
+    grid = torch.zeros(bs, n_max, 3, device=device)
+    grid[batch_ind, pos] = coords[:, 1:].float() * voxel_size + origin[batch_ind].float()
+    valid = torch.zeros(bs, n_max, dtype=torch.bool, device=device)
+    valid[batch_ind, pos] = True
 
-        coords_batch = coords_batch.view(-1, 3)
-        origin_batch = origin[batch].unsqueeze(0)
-        feats_batch = feats[:, batch]
-        proj_batch = KRcam[:, batch]
+    rs_grid = grid.permute(0, 2, 1)
+    rs_grid = torch.cat([rs_grid, torch.ones([bs, 1, n_max], device=device)], dim=1)
 
-        grid_batch = coords_batch * voxel_size + origin_batch.float()
-        rs_grid = grid_batch.unsqueeze(0).expand(n_views, -1, -1)
-        rs_grid = rs_grid.permute(0, 2, 1).contiguous()
-        nV = rs_grid.shape[-1]
-        rs_grid = torch.cat([rs_grid, torch.ones([n_views, 1, nV]).cuda()], dim=1)
+    # Project grid, (num of views, batch size, 4, max num of voxels)
+    im_p = KRcam @ rs_grid.unsqueeze(0)
+    im_x, im_y, im_z = im_p[:, :, 0], im_p[:, :, 1], im_p[:, :, 2]
+    im_x = im_x / im_z
+    im_y = im_y / im_z
 
-        # Project grid
-        im_p = proj_batch @ rs_grid
-        im_x, im_y, im_z = im_p[:, 0], im_p[:, 1], im_p[:, 2]
-        im_x = im_x / im_z
-        im_y = im_y / im_z
+    im_grid = torch.stack([2 * im_x / (w - 1) - 1, 2 * im_y / (h - 1) - 1], dim=-1)
+    mask = im_grid.abs() <= 1
+    mask = (mask.sum(dim=-1) == 2) & (im_z > 0) & valid.unsqueeze(0)
 
-        im_grid = torch.stack([2 * im_x / (w - 1) - 1, 2 * im_y / (h - 1) - 1], dim=-1)
-        mask = im_grid.abs() <= 1
-        mask = (mask.sum(dim=-1) == 2) & (im_z > 0)
+    feats = feats.reshape(n_views * bs, c, h, w)
+    im_grid = im_grid.view(n_views * bs, 1, -1, 2)
+    features = grid_sample(feats, im_grid, padding_mode='zeros', align_corners=True)
 
-        feats_batch = feats_batch.view(n_views, c, h, w)
-        im_grid = im_grid.view(n_views, 1, -1, 2)
-        features = grid_sample(feats_batch, im_grid, padding_mode='zeros', align_corners=True)
+    features = features.view(n_views, bs, c, -1)
+    # remove nan
+    features = features.masked_fill(~mask.unsqueeze(2), 0)
+    im_z = im_z.masked_fill(~mask, 0)
 
-        features = features.view(n_views, c, -1)
-        mask = mask.view(n_views, -1)
-        im_z = im_z.view(n_views, -1)
-        # remove nan
-        features[mask.unsqueeze(1).expand(-1, c, -1) == False] = 0
-        im_z[mask == False] = 0
+    # aggregate multi view
+    features = features.sum(dim=0)
+    mask = mask.sum(dim=0)
+    count = mask.float()
+    in_scope_mask = mask.clamp(min=1).unsqueeze(1)
+    features = features / in_scope_mask
+    features = features.permute(0, 2, 1)
 
-        count[batch_ind] = mask.sum(dim=0).float()
+    # concat normalized depth value, statistics are computed per batch over the visible voxels
+    im_z = im_z.sum(dim=0) / in_scope_mask.squeeze(1)
+    z_valid = im_z > 0
+    n_z_valid = z_valid.sum(dim=1, keepdim=True).float()
+    im_z_mean = (im_z * z_valid).sum(dim=1, keepdim=True) / n_z_valid
+    im_z_std = torch.sqrt((((im_z - im_z_mean) * z_valid) ** 2).sum(dim=1, keepdim=True)) + 1e-5
+    im_z_norm = torch.where(z_valid, (im_z - im_z_mean) / im_z_std, torch.zeros_like(im_z))
+    features = torch.cat([features, im_z_norm.unsqueeze(-1)], dim=-1)
 
-        # aggregate multi view
-        features = features.sum(dim=0)
-        mask = mask.sum(dim=0)
-        invalid_mask = mask == 0
-        mask[invalid_mask] = 1
-        in_scope_mask = mask.unsqueeze(0)
-        features /= in_scope_mask
-        features = features.permute(1, 0).contiguous()
-
-        # concat normalized depth value
-        im_z = im_z.sum(dim=0).unsqueeze(1) / in_scope_mask.permute(1, 0).contiguous()
-        im_z_mean = im_z[im_z > 0].mean()
-        im_z_std = torch.norm(im_z[im_z > 0] - im_z_mean) + 1e-5
-        im_z_norm = (im_z - im_z_mean) / im_z_std
-        im_z_norm[im_z <= 0] = 0
-        features = torch.cat([features, im_z_norm], dim=1)
-
-        feature_volume_all[batch_ind] = features
+    feature_volume_all = features[batch_ind, pos]
+    count = count[batch_ind, pos]
     return feature_volume_all, count
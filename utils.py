@@ -155,6 +155,14 @@ def apply_log_transform(tsdf):
     return out
 
 
+@torch.jit.script
+def tsdf_log_l1(tsdf, tsdf_target):
+    # log transform + l1 in one scripted function so the elementwise ops get fused
+    tsdf = apply_log_transform(tsdf)
+    tsdf_target = apply_log_transform(tsdf_target)
+    return torch.mean(torch.abs(tsdf - tsdf_target))
+
+
 def sparse_to_dense_torch_batch(locs, values, dim, default_val):
     dense = torch.full([dim[0], dim[1], dim[2], dim[3]], float(default_val), device=locs.device)
     dense[locs[:, 0], locs[:, 1], locs[:, 2], locs[:, 3]] = values